@@ -5,6 +5,7 @@ Each server can respond to a number of text commands over a TCP connection.
 import subprocess
 import socket
 import time
+import tracing
 
 
 __author__ = "Rory MacHale"
@@ -61,6 +62,7 @@ class Coordinator(object):
 
     # The following methods represent the public API of Controller.
 
+    @tracing.traced('coord.deploy')
     def deploy(self, tss, name, addr):
         """Launch a new server as a sub-process, using the specified address."""
         if addr.find(':') >= 0:
@@ -75,6 +77,7 @@ class Coordinator(object):
         return "Deployed test system #{0} '{1}', server '{2}' @{3}".format(
             tss[0], tss[1], name, addr)
 
+    @tracing.traced('coord.bool_check')
     def bool_check(self, addr):
         """Attempt to communicate with a server.
         Return True if OK, False otherwise."""
@@ -82,6 +85,7 @@ class Coordinator(object):
         status = self.ask_id(host, port)
         return (not isinstance(status, int)) or status != -1
 
+    @tracing.traced('coord.check')
     def check(self, ts_id, addr):
         """Request the ID os a server."""
         if addr.find(':') >= 0:
@@ -90,6 +94,7 @@ class Coordinator(object):
         return "Checking test system #{0}, server @{1}: ID={2}".format(
             ts_id, addr, sid)
 
+    @tracing.traced('coord.stop')
     def stop(self, ts_id, addr):
         """Stop a running server. Does nothing if the server isn't running."""
         if addr.find(':') >= 0:
@@ -2,7 +2,12 @@
 
 
 import sqlite3
+import struct
+import mmap
+import os
 from collections import namedtuple
+import coord
+import tracing
 
 
 __author__ = "Rory MacHale"
@@ -10,10 +15,116 @@ __version__ = "1.0"
 __date__ = "2015-05-15"
 
 
+# Seconds a connection waits on a locked database before giving up
+BUSY_TIMEOUT = 30.0
+
+# Range from which ports are allocated for servers declared without one
+PORT_LOW = 20000
+PORT_HIGH = 29999
+
+# Largest valid TCP port (ports are 1..PORT_MAX)
+PORT_MAX = 65535
+
+# Binary topology snapshot layout (all little-endian)::
+#
+#   header   magic, version, system count, server count
+#   systems  id, name, first server index, server count   (sorted by id)
+#   servers  id, system_id, addr, name                    (grouped by system)
+#   pool     UTF-8 string data
+#
+# Strings are stored as (offset, length) into the pool; NULL is NO_STRING.
+SNAP_MAGIC = b'LITESNAP'
+SNAP_VERSION = 1
+SNAP_HEADER = struct.Struct('<8sIII')
+SNAP_SYSTEM = struct.Struct('<IIIII')
+SNAP_SERVER = struct.Struct('<IIIIII')
+NO_STRING = 0xFFFFFFFF
+
 # Represents a single server, with an (IP or domain) address and a name
 Server = namedtuple('Server', ('addr', 'name'))
 
 
+def normaddr(addr):
+    """Normalise an address to the (host, port) key used by the address
+    index: host as split by Coordinator.splitaddr, lower-cased, and an
+    integer port. Raises ValueError naming addr if the port is not a number
+    in 1..PORT_MAX."""
+    host, port = coord.Coordinator.splitaddr(addr)
+    try:
+        port = int(port)
+    except ValueError:
+        port = None
+    if port is None or not 0 < port <= PORT_MAX:
+        raise ValueError("Invalid port in address {0!r}".format(addr))
+    return host.strip().lower(), port
+
+
+def check_ports(low, high):
+    """Raise ValueError unless low..high is a non-empty range of valid ports."""
+    if not 0 < low <= high <= PORT_MAX:
+        raise ValueError("Invalid port range {0}-{1}".format(low, high))
+
+
+def duplicates(addrs):
+    """Return the (host, port) keys which occur more than once in addrs."""
+    seen = set()
+    dups = set()
+    for key in addrs:
+        if key in seen:
+            dups.add(key)
+        seen.add(key)
+    return sorted(dups)
+
+
+class AddressConflict(ValueError):
+    """Raised when servers claim a host:port which is already in use.
+    The conflicting (host, port) keys are available as addrs."""
+    def __init__(self, addrs, msg="Address already in use"):
+        self.addrs = addrs
+        shown = ', '.join('{0}:{1}'.format(*key) for key in addrs[:10])
+        more = ' (+{0} more)'.format(len(addrs)-10) if len(addrs) > 10 else ''
+        ValueError.__init__(self, "{0}: {1}{2}".format(msg, shown, more))
+
+
+class PortAllocator(object):
+    """Assigns free ports from the range low..high, per host. Ports already
+    in the address index, or reserved, are skipped. Used ports for a host
+    are fetched from the index once, on first use. Raises ValueError if
+    the range is invalid."""
+    def __init__(self, tsdb, low=PORT_LOW, high=PORT_HIGH):
+        check_ports(low, high)
+        self.tsdb = tsdb
+        self.low = low
+        self.high = high
+        self.used = {}
+        self.next = {}
+
+    def ports(self, host):
+        """Return the set of used ports in range for host."""
+        if host not in self.used:
+            self.used[host] = set(self.tsdb.used_ports(host, self.low, self.high))
+            self.next[host] = self.low
+        return self.used[host]
+
+    def reserve(self, host, port):
+        """Mark host:port as in use."""
+        if self.low <= port <= self.high:
+            self.ports(host).add(port)
+
+    def allocate(self, host):
+        """Return the lowest free port for host, and mark it as in use."""
+        used = self.ports(host)
+        port = self.next[host]
+        while port in used:
+            port += 1
+        if port > self.high:
+            raise AddressConflict([(host, port)],
+                "No free port in {0}-{1}".format(self.low, self.high))
+        used.add(port)
+        self.next[host] = port + 1
+        return port
+
+
 class SystemIterator(object):
     """Iterator for a System object. Iterates over the stored servers."""
     def __init__(self, system):
@@ -68,16 +179,34 @@ class System(object):
 
 
 class Database(object):
-    """Encapsulates an sqlite3 database storing test-systems and servers."""
-    def __init__(self, name):
-        self.dbc = sqlite3.connect(name)
+    """Encapsulates an sqlite3 database storing test-systems and servers.
+
+    Connections use WAL journaling so that readers (the web server) and a
+    writer (reader.py add) may use the database concurrently. Pass
+    readonly=True for connections which only ever query the database."""
+    def __init__(self, name, readonly=False, timeout=BUSY_TIMEOUT):
+        self.readonly = readonly
+        self.dbc = sqlite3.connect(name, timeout=timeout)
+        self.dbc.execute("PRAGMA busy_timeout={0:d}".format(int(timeout*1000)))
+        if readonly:
+            self.dbc.execute("PRAGMA query_only=ON")
+        else:
+            self.dbc.execute("PRAGMA journal_mode=WAL")
+            self.dbc.execute("PRAGMA synchronous=NORMAL")
+            tables = set(row[0] for row in self.dbc.execute(
+                "SELECT name FROM sqlite_master WHERE type='table'"))
+            if 'server' in tables and 'address' not in tables:
+                self.index_addresses()
+            self.dbc.execute(
+                "CREATE TEMP TABLE IF NOT EXISTS probe (host varchar(32), port integer)")
 
     def create(self):
-        """Drop an existing database and create empty tables. There are two
+        """Drop an existing database and create empty tables. There are three
         tables::
 
             system - stores test-systems with their names
             server - stores servers with their names, and addresses
+            address - unique index of server addresses, as (host, port)
 
         There is a 1:N relation between system and server rows."""
         cur = self.dbc.cursor()
@@ -86,8 +215,75 @@ class Database(object):
         cur.execute("DROP TABLE IF EXISTS server")
         cur.execute("CREATE TABLE server"+
             "(id integer primary key, system_id integer, addr varchar(32), name varchar(32))")
+        self.create_address()
+        self.dbc.commit()
+
+    def create_address(self):
+        """Drop and create the (empty) address index table."""
+        cur = self.dbc.cursor()
+        cur.execute("DROP TABLE IF EXISTS address")
+        cur.execute("CREATE TABLE address (host varchar(32), port integer)")
+        cur.execute("CREATE UNIQUE INDEX address_hostport ON address (host, port)")
+
+    def index_addresses(self):
+        """Rebuild the address index from the server table, for databases
+        created before the index existed. Duplicate addresses are indexed
+        once. Addresses which cannot be normalised are not indexed; these
+        are returned as a list."""
+        self.create_address()
+        cur = self.dbc.cursor()
+        cur.execute("SELECT addr FROM server WHERE addr IS NOT NULL")
+        keys = []
+        invalid = []
+        for row in cur:
+            try:
+                keys.append(normaddr(row[0]))
+            except ValueError:
+                invalid.append(row[0])
+        self.dbc.executemany("INSERT OR IGNORE INTO address (host, port) VALUES (?, ?)",
+            keys)
         self.dbc.commit()
+        return invalid
+
+    @tracing.traced('db.find_conflicts')
+    def find_conflicts(self, addrs):
+        """Return those (host, port) keys in addrs which are already in the
+        address index. The keys are checked in bulk with a single join."""
+        cur = self.dbc.cursor()
+        cur.execute("DELETE FROM probe")
+        cur.executemany("INSERT INTO probe (host, port) VALUES (?, ?)", addrs)
+        cur.execute("SELECT probe.host, probe.port FROM probe JOIN address "+
+            "ON address.host=probe.host AND address.port=probe.port "+
+            "ORDER BY probe.host, probe.port")
+        return cur.fetchall()
+
+    def used_ports(self, host, low, high):
+        """Generator for the indexed ports of host in the range low..high."""
+        cur = self.dbc.cursor()
+        with tracing.span('db.used_ports'):
+            cur.execute("SELECT port FROM address WHERE host=? AND port BETWEEN ? AND ?",
+                (host, low, high))
+            rows = cur.fetchall()
+        for row in rows:
+            yield row[0]
 
+    @tracing.traced('db.index_address')
+    def index_address(self, addrs, checked=False):
+        """Add (host, port) keys to the address index. Raises
+        AddressConflict, without changing the index, if any is duplicated
+        or already present. If checked is True the caller has already
+        checked addrs (see reader.assign_addresses), and only the unique
+        index guards against conflicts."""
+        if not checked:
+            conflicts = duplicates(addrs) or self.find_conflicts(addrs)
+            if conflicts:
+                raise AddressConflict(conflicts)
+        try:
+            self.dbc.executemany("INSERT INTO address (host, port) VALUES (?, ?)", addrs)
+        except sqlite3.IntegrityError:
+            raise AddressConflict(duplicates(addrs) or addrs)
+
+    @tracing.traced('db.write_system')
     def write_system(self, name):
         """Add a new test-system entry. Returns the id value so it may be
         used as a foreign key.
@@ -96,14 +292,30 @@ class Database(object):
         cur.execute("INSERT INTO system (name) VALUES (?)", (name,))
         return cur.lastrowid
 
+    @tracing.traced('db.write_server')
     def write_server(self, system_id, addr, name):
         """Add a new server entry. Requires the foreign key (id) of the
         associated test-system.
         NB: You must exlicitly call db.commit() to save changes."""
+        if addr is not None:
+            self.index_address([normaddr(addr)])
         cur = self.dbc.cursor()
         cur.execute("INSERT INTO server (system_id, addr, name) VALUES (?, ?, ?)",
             (system_id, addr, name))
 
+    @tracing.traced('db.write_servers')
+    def write_servers(self, system_id, servers, checked=False):
+        """Bulk-add server entries, given as (addr, name) pairs, for the
+        test-system system_id. Pass checked=True if the addresses have
+        already been checked for conflicts (see index_address).
+        NB: You must exlicitly call db.commit() to save changes."""
+        self.index_address(
+            [normaddr(addr) for addr, _ in servers if addr is not None], checked)
+        cur = self.dbc.cursor()
+        cur.executemany("INSERT INTO server (system_id, addr, name) VALUES (?, ?, ?)",
+            ((system_id, addr, name) for addr, name in servers))
+
+    @tracing.traced('db.read_system')
     def read_system(self, system_id):
         """Returns the test-system name corresponding to system_id."""
         cur = self.dbc.cursor()
@@ -113,21 +325,26 @@ class Database(object):
     def read_servers(self, system_id):
         """Generator for all servers associated with system_id."""
         cur = self.dbc.cursor()
-        cur.execute("SELECT * FROM server WHERE system_id=?", (system_id,))
-        for row in cur:
+        with tracing.span('db.read_servers'):
+            cur.execute("SELECT * FROM server WHERE system_id=?", (system_id,))
+            rows = cur.fetchall()
+        for row in rows:
             yield row
 
     def read_all(self):
         """Generator for all test-systems. Each test-system is returned as
         a System object, with associated servers already added."""
         cur = self.dbc.cursor()
-        cur.execute("SELECT * FROM system")
-        for row in cur:
+        with tracing.span('db.read_all'):
+            cur.execute("SELECT * FROM system")
+            rows = cur.fetchall()
+        for row in rows:
             sys = System(*row)
             for srv in self.read_servers(row[0]):
                 sys.add_server(*srv[2:])
             yield sys
 
+    @tracing.traced('db.commit')
     def commit(self):
         """Commit changes to the database. This is not done automatically within
         the database object, as committing after every change will very
@@ -135,3 +352,144 @@ class Database(object):
         the application when updates are complete."""
         self.dbc.commit()
 
+    def write_snapshot(self, name):
+        """Compile the system and server tables into a binary snapshot file
+        which may be loaded with Snapshot. The file is written under a
+        temporary name and renamed, so readers never see a partial file."""
+        pool = []
+        offsets = {}
+        size = [0]
+
+        def intern(text):
+            """Add a string to the pool, returning (offset, length)."""
+            if text is None:
+                return NO_STRING, 0
+            data = text.encode('utf-8')
+            if data not in offsets:
+                offsets[data] = size[0]
+                pool.append(data)
+                size[0] += len(data)
+            return offsets[data], len(data)
+
+        cur = self.dbc.cursor()
+        cur.execute("SELECT id, system_id, addr, name FROM server ORDER BY system_id, id")
+        servers = []
+        first = {}
+        count = {}
+        for srv_id, system_id, srv_addr, srv_name in cur:
+            first.setdefault(system_id, len(servers))
+            count[system_id] = count.get(system_id, 0) + 1
+            servers.append(SNAP_SERVER.pack(
+                srv_id, system_id, *(intern(srv_addr) + intern(srv_name))))
+        cur.execute("SELECT id, name FROM system ORDER BY id")
+        systems = [SNAP_SYSTEM.pack(tsid, *(intern(tsname) + (
+            first.get(tsid, len(servers)), count.get(tsid, 0))))
+            for tsid, tsname in cur]
+        tmpname = name + '.tmp'
+        fps = open(tmpname, 'wb')
+        fps.write(SNAP_HEADER.pack(
+            SNAP_MAGIC, SNAP_VERSION, len(systems), len(servers)))
+        fps.write(b''.join(systems))
+        fps.write(b''.join(servers))
+        fps.write(b''.join(pool))
+        fps.close()
+        os.rename(tmpname, name)
+
+
+class Snapshot(object):
+    """Read-only, Database-compatible view of a binary topology snapshot
+    written by Database.write_snapshot. The file is memory-mapped, so the
+    pages are shared by every process which loads the same snapshot."""
+    def __init__(self, name):
+        self.name = name
+        fps = open(name, 'rb')
+        stat = os.fstat(fps.fileno())
+        self.stamp = (stat.st_ino, stat.st_mtime)
+        self.buf = mmap.mmap(fps.fileno(), 0, access=mmap.ACCESS_READ)
+        fps.close()
+        magic, version, self.nsystems, self.nservers = \
+            SNAP_HEADER.unpack_from(self.buf, 0)
+        if magic != SNAP_MAGIC or version != SNAP_VERSION:
+            raise ValueError("{0}: not a version {1} snapshot".format(
+                name, SNAP_VERSION))
+        self.systems = SNAP_HEADER.size
+        self.servers = self.systems + self.nsystems*SNAP_SYSTEM.size
+        self.pool = self.servers + self.nservers*SNAP_SERVER.size
+
+    def close(self):
+        """Unmap the snapshot file."""
+        self.buf.close()
+
+    def changed(self):
+        """Return True if the file name has been replaced or modified since
+        it was mapped. A removed file counts as unchanged."""
+        try:
+            stat = os.stat(self.name)
+        except OSError:
+            return False
+        return (stat.st_ino, stat.st_mtime) != self.stamp
+
+    def string(self, offset, length):
+        """Return a string from the pool."""
+        if offset == NO_STRING:
+            return None
+        start = self.pool + offset
+        return self.buf[start:start+length].decode('utf-8')
+
+    def system(self, idx):
+        """Return the idx'th entry of the system table."""
+        return SNAP_SYSTEM.unpack_from(self.buf, self.systems + idx*SNAP_SYSTEM.size)
+
+    def find_system(self, system_id):
+        """Binary search the system table for system_id. Returns the table
+        entry, or None if not found."""
+        low, high = 0, self.nsystems
+        while low < high:
+            mid = (low + high) // 2
+            entry = self.system(mid)
+            if entry[0] < system_id:
+                low = mid + 1
+            elif entry[0] > system_id:
+                high = mid
+            else:
+                return entry
+        return None
+
+    @tracing.traced('db.read_system')
+    def read_system(self, system_id):
+        """Returns the test-system row (id, name) corresponding to system_id."""
+        entry = self.find_system(system_id)
+        if entry is None:
+            return None
+        return entry[0], self.string(entry[1], entry[2])
+
+    def servers_of(self, entry):
+        """Generator for the server rows of a system table entry."""
+        for idx in xrange(entry[3], entry[3] + entry[4]):
+            srv_id, system_id, aoff, alen, noff, nlen = SNAP_SERVER.unpack_from(
+                self.buf, self.servers + idx*SNAP_SERVER.size)
+            yield srv_id, system_id, self.string(aoff, alen), self.string(noff, nlen)
+
+    def read_entry_servers(self, entry):
+        """Return the server rows of a system table entry, traced as
+        db.read_servers like the equivalent Database query."""
+        with tracing.span('db.read_servers'):
+            return list(self.servers_of(entry))
+
+    def read_servers(self, system_id):
+        """Generator for all servers associated with system_id."""
+        entry = self.find_system(system_id)
+        if entry is not None:
+            for row in self.read_entry_servers(entry):
+                yield row
+
+    def read_all(self):
+        """Generator for all test-systems, as System objects with
+        associated servers already added."""
+        with tracing.span('db.read_all'):
+            entries = [self.system(idx) for idx in xrange(self.nsystems)]
+        for entry in entries:
+            sys = System(entry[0], self.string(entry[1], entry[2]))
+            for srv in self.read_entry_servers(entry):
+                sys.add_server(*srv[2:])
+            yield sys
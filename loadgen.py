@@ -0,0 +1,166 @@
+"""Load generator for simulated test-systems. Opens a number of concurrent
+clients against the servers of a test-system and issues HELO and/or ID
+requests, either at a target rate or as fast as possible, then reports
+throughput, latency percentiles and error counts.
+"""
+
+from collections import namedtuple
+import threading
+import socket
+import errno
+import math
+import time
+import database
+import coord
+
+
+__author__ = "Rory MacHale"
+__version__ = "1.0"
+__date__ = "2015-05-15"
+
+
+# Expected reply prefix for each request
+REPLIES = {'HELO': 'OLEH\n', 'ID': 'ID '}
+
+# Summary of a load run. Latencies are in seconds.
+Stats = namedtuple('Stats', ('requests', 'errors', 'refused', 'seconds',
+    'throughput', 'p50', 'p95', 'p99'))
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a sorted list of values (None if empty)."""
+    if not values:
+        return None
+    idx = max(0, int(math.ceil(pct/100.0*len(values))) - 1)
+    return values[idx]
+
+
+def read_addrs(dbname, ts_id):
+    """Return the server addresses of test-system ts_id."""
+    tsdb = database.Database(dbname, readonly=True)
+    return [server[2] for server in tsdb.read_servers(ts_id)]
+
+
+class LoadGenerator(object):
+    """Drives a set of servers with concurrent clients. Each client opens a
+    new connection per request, as the server protocol requires, cycling
+    through the server addresses."""
+    def __init__(self, addrs, clients=10, rate=None, duration=10.0,
+                 requests=None, commands=('HELO',), timeout=5.0):
+        """rate is the target total requests/second (None: unthrottled).
+        Clients stop after duration seconds or requests requests each,
+        whichever comes first."""
+        self.addrs = [coord.Coordinator.splitaddr(addr) for addr in addrs]
+        self.clients = clients
+        self.rate = rate
+        self.duration = duration
+        self.requests = requests
+        self.commands = commands
+        self.timeout = timeout
+        self.results = []
+
+    def request(self, host, port, cmd, scheduled=None):
+        """Send one request and check the reply. Returns the latency in
+        seconds, measured from scheduled (when the request was due, if
+        pacing) so time spent waiting behind a slow reply is counted.
+        Raises socket.error or ValueError on failure."""
+        start = time.time() if scheduled is None else scheduled
+        sock = socket.create_connection((host, int(port)), self.timeout)
+        try:
+            sock.send("{0}\n".format(cmd))
+            data = sock.recv(1024) # Naive TCP stream handling ... :-)
+        finally:
+            sock.close()
+        if not data.startswith(REPLIES[cmd]):
+            raise ValueError("Unexpected reply {0!r} to {1}".format(data, cmd))
+        return time.time() - start
+
+    def client(self, idx):
+        """Client thread. Issues requests until the deadline or request
+        limit, pacing them if a rate is set, and records the outcome."""
+        latencies = []
+        errors = 0
+        refused = 0
+        interval = float(self.clients) / self.rate if self.rate else 0.0
+        start = time.time()
+        deadline = start + self.duration
+        count = 0
+        while time.time() < deadline and (
+                self.requests is None or count < self.requests):
+            scheduled = None
+            if interval:
+                scheduled = start + count*interval
+                delay = scheduled - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            host, port = self.addrs[(idx + count) % len(self.addrs)]
+            cmd = self.commands[count % len(self.commands)]
+            count += 1
+            try:
+                latencies.append(self.request(host, port, cmd, scheduled))
+            except socket.error as exc:
+                if exc.errno == errno.ECONNREFUSED:
+                    refused += 1
+                else:
+                    errors += 1
+            except ValueError:
+                errors += 1
+        self.results.append((latencies, errors, refused))
+
+    def run(self):
+        """Run the clients to completion and return Stats."""
+        self.results = []
+        threads = [threading.Thread(target=self.client, args=(idx,))
+                   for idx in xrange(self.clients)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        seconds = time.time() - start
+        latencies = sorted(lat for result in self.results for lat in result[0])
+        errors = sum(result[1] for result in self.results)
+        refused = sum(result[2] for result in self.results)
+        return Stats(len(latencies)+errors+refused, errors, refused, seconds,
+            len(latencies) / seconds if seconds else 0.0,
+            percentile(latencies, 50), percentile(latencies, 95),
+            percentile(latencies, 99))
+
+
+def report(stats):
+    """Format Stats as a human-readable report."""
+    def msec(value):
+        return 'n/a' if value is None else '{0:.2f}ms'.format(value*1000)
+    return "\n".join([
+        "requests={0} errors={1} refused={2} in {3:.2f}s".format(
+            stats.requests, stats.errors, stats.refused, stats.seconds),
+        "throughput={0:.1f} req/s".format(stats.throughput),
+        "latency p50={0} p95={1} p99={2}".format(
+            msec(stats.p50), msec(stats.p95), msec(stats.p99))])
+
+
+def main():
+    """CLI: drive the servers of a test-system from the database."""
+    import argparse
+    parser = argparse.ArgumentParser(description="LITE load generator")
+    parser.add_argument('ts_id', type=int, help='Test-system id')
+    parser.add_argument('-d', '--db', default='sample.db', help="SQLite DB filename")
+    parser.add_argument('-c', '--clients', default=10, type=int, help='Concurrent clients')
+    parser.add_argument('-r', '--rate', type=float,
+        help='Target requests/second in total (default: as fast as possible)')
+    parser.add_argument('-t', '--duration', default=10.0, type=float, help='Seconds to run')
+    parser.add_argument('-n', '--requests', type=int, help='Requests per client')
+    parser.add_argument('-m', '--command', default='HELO', choices=('HELO', 'ID', 'mix'),
+        help='Request to issue (mix: alternate HELO and ID)')
+    args = parser.parse_args()
+    addrs = read_addrs(args.db, args.ts_id)
+    if not addrs:
+        raise SystemExit("No servers in test system #{0}".format(args.ts_id))
+    commands = ('HELO', 'ID') if args.command == 'mix' else (args.command,)
+    gen = LoadGenerator(addrs, args.clients, args.rate, args.duration,
+        args.requests, commands)
+    print report(gen.run())
+
+
+if __name__ == "__main__":
+    main()
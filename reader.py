@@ -2,9 +2,10 @@
 into a database. Can be invoked as a CLI, or imported and used as a module.
 """
 
-from lxml import etree # pragme: no cover
 import database
+import glob
 import os
+import time
 
 
 __author__ = "Rory MacHale"
@@ -12,6 +13,13 @@ __version__ = "1.0"
 __date__ = "2015-05-15"
 
 
+# Number of servers written between commits during an import
+CHUNK_SIZE = 500
+
+# Port range for servers declared without a port
+PORTS = (database.PORT_LOW, database.PORT_HIGH)
+
+
 class XMLProcessor(object):
     """Translates an XML file to/from a database."""
 
@@ -22,6 +30,7 @@ class XMLProcessor(object):
 
     def read_xml(self):
         """Read in the XML specification."""
+        from lxml import etree # Imported here: only XML parse and generate need lxml
         return etree.parse(open(self.xmlname, 'rb'))
 
     def write_xml(self):
@@ -30,20 +39,24 @@ class XMLProcessor(object):
         fpx.write(self.gen_xml())
         fpx.close()
 
-    def save(self):
-        """Save the XML specification to the datbase."""
+    def rows(self):
+        """Parse the XML specification into a compact row batch: a list of
+        (system-name, [(addr, name), ...]) tuples, in document order."""
         tree = self.read_xml()
-        lastts = None
-        for tss in tree.getroot():
-            if tss != lastts:
-                ts_id = self.tsdb.write_system(tss.get('name'))
-                lastts = tss
-            for sys in tss:
-                self.tsdb.write_server(ts_id, sys.get('addr'), sys.get('name'))
-        self.tsdb.commit()
+        return [(tss.get('name'),
+                 [(srv.get('addr'), srv.get('name')) for srv in tss])
+                for tss in tree.getroot()]
+
+    def save(self, chunk=CHUNK_SIZE, ports=PORTS):
+        """Save the XML specification to the datbase. Changes are committed
+        every chunk servers so that the write lock is held only briefly and
+        concurrent readers are not stalled by a large import. Servers
+        without a port are allocated one from the range ports."""
+        write_rows(self.tsdb, self.rows(), chunk, ports)
 
     def gen_xml(self):
         """Generate XML from the database."""
+        from lxml import etree
         root = etree.Element('testsystem')
         allsys = self.tsdb.read_all()
         for tss in allsys:
@@ -55,22 +68,135 @@ class XMLProcessor(object):
         return etree.tostring(root, pretty_print=True)
 
 
+def parse_xml(xmlname):
+    """Worker function: parse an XML file into a row batch (see
+    XMLProcessor.rows). Module level so it can be run in a process pool."""
+    return XMLProcessor(xmlname, None).rows()
 
-def import_xml(xmlname, dbname, create=False):
-    """API function which can be called to read an XML file into a database.
-    Add to the database by default, or if create is True,
-    clear database first."""
+
+def assign_addresses(tsdb, rows, ports=PORTS):
+    """Check a row batch against the address index and allocate ports, from
+    the range ports, to servers declared without one (host defaults to
+    localhost). Returns the row batch with complete addresses. Raises
+    AddressConflict, before anything is written, if any address is in use."""
+    addrs = [database.normaddr(addr) for _, servers in rows
+             for addr, _ in servers if addr and ':' in addr]
+    conflicts = database.duplicates(addrs) or tsdb.find_conflicts(addrs)
+    if conflicts:
+        raise database.AddressConflict(conflicts)
+    alloc = database.PortAllocator(tsdb, *ports)
+    for host, port in addrs:
+        alloc.reserve(host, port)
+    result = []
+    for name, servers in rows:
+        assigned = []
+        for addr, srv_name in servers:
+            if not addr or ':' not in addr:
+                host = (addr or 'localhost').strip().lower()
+                addr = '{0}:{1}'.format(host, alloc.allocate(host))
+            assigned.append((addr, srv_name))
+        result.append((name, assigned))
+    return result
+
+
+def write_rows(tsdb, rows, chunk=CHUNK_SIZE, ports=PORTS):
+    """Bulk-insert a row batch into the database, committing every chunk
+    servers (0 commits once, at the end). Addresses are checked and
+    allocated once, up front (see assign_addresses), so the inserts skip
+    the per-batch conflict check. Returns the number of servers."""
+    rows = assign_addresses(tsdb, rows, ports)
+    total = 0
+    pending = 0
+    for name, servers in rows:
+        ts_id = tsdb.write_system(name)
+        idx = 0
+        while idx < len(servers):
+            count = chunk - pending if chunk else len(servers)
+            batch = servers[idx:idx+count]
+            tsdb.write_servers(ts_id, batch, checked=True)
+            idx += len(batch)
+            pending += len(batch)
+            if chunk and pending >= chunk:
+                tsdb.commit()
+                pending = 0
+        total += len(servers)
+    tsdb.commit()
+    return total
+
+
+def expand_inputs(paths):
+    """Expand a list of XML inputs. Each may be a file, a directory (all
+    *.xml files within it) or a glob pattern. Expansions are sorted so the
+    import order is repeatable. Raises ValueError if a file is missing, or
+    a directory or pattern matches no files."""
+    names = []
+    for path in paths:
+        if os.path.isdir(path):
+            matched = sorted(glob.glob(os.path.join(path, '*.xml')))
+        elif glob.has_magic(path):
+            matched = sorted(glob.glob(path))
+        elif os.path.isfile(path):
+            matched = [path]
+        else:
+            raise ValueError("No such XML file: {0}".format(path))
+        if not matched:
+            raise ValueError("No XML files match {0}".format(path))
+        names.extend(matched)
+    return names
+
+
+def open_db(dbname, create=False):
+    """Open dbname for an import, clearing it first if create is True.
+    A database which does not exist yet is always created."""
     create = create or (not os.path.exists(dbname))
     tsdb = database.Database(dbname)
     if create:
         tsdb.create()
+    return tsdb
+
+
+def import_xml(xmlname, dbname, create=False, chunk=CHUNK_SIZE, ports=PORTS):
+    """API function which can be called to read an XML file into a database.
+    Add to the database by default, or if create is True,
+    clear database first. Changes are committed every chunk servers
+    (0 commits once, at the end). Servers without a port are allocated
+    one from the range ports."""
+    tsdb = open_db(dbname, create)
     xml = XMLProcessor(xmlname, tsdb)
-    xml.save()
+    xml.save(chunk, ports)
+
+
+def import_many(xmlnames, dbname, create=False, chunk=CHUNK_SIZE, jobs=None,
+                ports=PORTS):
+    """API function which reads many XML files into a database. Files are
+    parsed in parallel by a pool of jobs worker processes (default: one per
+    CPU) and the resulting row batches are written, in input order, by this
+    process alone. Addresses are checked per file, so on AddressConflict the
+    preceding files remain imported. Returns (files, servers, seconds).
+    Raises ValueError, before the database is opened, if there are no
+    files, any is missing, or the port range is invalid."""
+    if not xmlnames:
+        raise ValueError("No XML files to import")
+    database.check_ports(*ports)
+    for xmlname in xmlnames:
+        if not os.path.isfile(xmlname):
+            raise ValueError("No such XML file: {0}".format(xmlname))
+    from concurrent.futures import ProcessPoolExecutor
+    start = time.time()
+    total = 0
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        # Submit the parse jobs, which starts the workers, before opening
+        # the database so they do not inherit its connection
+        batches = pool.map(parse_xml, xmlnames)
+        tsdb = open_db(dbname, create)
+        for rows in batches:
+            total += write_rows(tsdb, rows, chunk, ports)
+    return len(xmlnames), total, time.time() - start
 
 
 def do_list(args): # pragma: no cover
     """CLI list command. List database contents to stdout."""
-    tsdb = database.Database(args.db)
+    tsdb = database.Database(args.db, readonly=True)
     for sys in tsdb.read_all():
         for srv in sys:
             print '#{0:3d} ts={1} addr={2} name={3}'.format(
@@ -79,22 +205,41 @@ def do_list(args): # pragma: no cover
 
 def do_add(args): # pragma: no cover
     """CLI add command. Read XML file and store in database,
-    optionally clearing database first."""
-    import_xml(args.xml, args.db, args.create)
+    optionally clearing database first. Several files, directories or
+    glob patterns may be given; these are parsed in parallel."""
+    try:
+        xmlnames = expand_inputs(args.xml)
+        files, servers, secs = import_many(xmlnames, args.db, args.create,
+            args.chunk, args.jobs, (args.port_low, args.port_high))
+    except ValueError as exc: # Includes AddressConflict, invalid addresses and ports
+        raise SystemExit(str(exc))
+    print "Imported {0} servers from {1} files in {2:.2f}s ({3:.0f} rows/s)".format(
+        servers, files, secs, servers / secs if secs else 0.0)
 
 
 def do_gen(args): # pragma: no cover
     """CLI gen command. Generate an XML file from the stored
     data in the database."""
-    tsdb = database.Database(args.db)
+    tsdb = database.Database(args.db, readonly=True)
     xml = XMLProcessor(args.xml, tsdb)
     xml.write_xml()
 
 
+def do_snapshot(args): # pragma: no cover
+    """CLI snapshot command. Compile the database into a binary snapshot
+    file which the web server can load read-only."""
+    tsdb = database.Database(args.db, readonly=True)
+    name = args.output or os.path.splitext(args.db)[0]+'.snap'
+    tsdb.write_snapshot(name)
+    print "Wrote {0}".format(name)
+
+
 def main():
-    """CLI: process command line. There are two sub-commands:
+    """CLI: process command line. There are four sub-commands:
         add: to add an XML specification to the database
         list: to list the contents of the database
+        gen: to generate an XML specification from the database
+        snapshot: to compile the database into a binary snapshot
     """
     import argparse
     parser = argparse.ArgumentParser(description="Test system XML reader")
@@ -103,12 +248,23 @@ def main():
     p_add = sub.add_parser('add', help='Add data from XML')
     p_add.set_defaults(func=do_add)
     p_add.add_argument('-c', '--create', action='store_true', help="Create new database")
-    p_add.add_argument('-x', '--xml', default='sample.xml', help='Input XML file')
+    p_add.add_argument('-x', '--xml', nargs='+', default=['sample.xml'],
+        help='Input XML files, directories or glob patterns')
+    p_add.add_argument('-j', '--jobs', type=int, help='Parser processes (default: CPUs)')
+    p_add.add_argument('-n', '--chunk', default=CHUNK_SIZE, type=int,
+        help='Servers written per commit (0: single commit)')
+    p_add.add_argument('--port-low', default=PORTS[0], type=int,
+        help='First port allocated to servers without one')
+    p_add.add_argument('--port-high', default=PORTS[1], type=int,
+        help='Last port allocated to servers without one')
     p_list = sub.add_parser('list', help='List data in database')
     p_list.set_defaults(func=do_list)
     p_gen = sub.add_parser('gen', help='Generate XML from database')
     p_gen.set_defaults(func=do_gen)
     p_gen.add_argument('-x', '--xml', default='sample.xml', help='Input XML file')
+    p_snap = sub.add_parser('snapshot', help='Compile database to a binary snapshot')
+    p_snap.set_defaults(func=do_snapshot)
+    p_snap.add_argument('-o', '--output', help='Snapshot file (default: <db>.snap)')
     args = parser.parse_args()
     args.func(args)
 
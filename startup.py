@@ -0,0 +1,73 @@
+"""Startup-time measurement for LITE. Runs each command in a fresh
+interpreter a number of times and reports the best and median wall-clock
+times, so cold start of the web app and CLI subcommands can be tracked.
+"""
+
+import subprocess
+import time
+import sys
+import os
+
+
+__author__ = "Rory MacHale"
+__version__ = "1.0"
+__date__ = "2015-05-15"
+
+
+def commands(dbname):
+    """Return the (name, argv) commands measured by default. reader list
+    is only measured if the database exists, as it would create it."""
+    python = sys.executable
+    cmds = [
+        ('import web', [python, '-c', 'import web']),
+        ('reader --help', [python, 'reader.py', '--help']),
+        ('loadgen --help', [python, 'loadgen.py', '--help']),
+    ]
+    if os.path.exists(dbname):
+        cmds.append(('reader list', [python, 'reader.py', dbname, 'list']))
+    return cmds
+
+
+def measure(argv, repeat=5):
+    """Run argv repeat times, discarding its output. Returns the sorted
+    list of wall-clock times in seconds."""
+    times = []
+    devnull = open(os.devnull, 'wb')
+    for _ in xrange(repeat):
+        start = time.time()
+        subprocess.call(argv, stdout=devnull, stderr=devnull)
+        times.append(time.time() - start)
+    devnull.close()
+    return sorted(times)
+
+
+def loaded(module, code):
+    """Return True if running code in a fresh interpreter loads module."""
+    check = "{0}\nimport sys\nsys.exit(3 if '{1}' in sys.modules else 2)".format(
+        code, module)
+    return subprocess.call([sys.executable, '-c', check]) == 3
+
+
+def main():
+    """CLI: report startup times, optionally failing if any is too slow."""
+    import argparse
+    parser = argparse.ArgumentParser(description="LITE startup-time measurement")
+    parser.add_argument('-d', '--db', default='sample.db', help="SQLite DB filename")
+    parser.add_argument('-n', '--repeat', default=5, type=int, help='Runs per command')
+    parser.add_argument('--max', type=float,
+        help='Exit with an error if any best time exceeds this (seconds)')
+    args = parser.parse_args()
+    slow = []
+    for name, argv in commands(args.db):
+        times = measure(argv, args.repeat)
+        best, median = times[0], times[len(times)//2]
+        print "{0:16s} best={1:.1f}ms median={2:.1f}ms".format(
+            name, best*1000, median*1000)
+        if args.max is not None and best > args.max:
+            slow.append(name)
+    if slow:
+        raise SystemExit("Too slow: {0}".format(', '.join(slow)))
+
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,8 @@ from hashlib import sha256
 import sqlite3
 from lxml import etree # pragma: no cover
 import time
+import shutil
+import sys
 import os
 
 import reader
@@ -14,6 +16,9 @@ import coord
 import database
 import server
 import web
+import loadgen
+import tracing
+import startup
 
 
 SHA_INDEX_TMPL = "9ae200dde1dd0fabe4d55d7d1bc342fe0d62e1471e97f72dc8c1cf7e0dc52d31"
@@ -125,6 +130,124 @@ class ReaderTests(unittest.TestCase):
         data2 = xml.gen_xml()
         self.assertEqual(sha(data1), sha(data2))
 
+    def test_chunked(self):
+        """Import committing in small chunks gives the same database."""
+        reader.import_xml(self.xml, self.dbname, create=True, chunk=7)
+        self.check_db(self.spec)
+
+    def test_many(self):
+        """Import several XML specifications in parallel, preserving order."""
+        xml2 = 'test2.xml'
+        create_xml(
+            xml2, self.spec, port_base=2050+sum(self.spec), ts_base=len(self.spec))
+        self.addCleanup(os.unlink, xml2)
+        xmlnames = reader.expand_inputs(['test.xml', 'test[2].xml'])
+        self.assertEqual(xmlnames, [self.xml, xml2])
+        files, servers, _ = reader.import_many(
+            xmlnames, self.dbname, create=True, chunk=7, jobs=2)
+        self.assertEqual((files, servers), (2, 2*sum(self.spec)))
+        self.check_db(self.spec + self.spec)
+
+    def test_no_inputs(self):
+        """Missing or unmatched inputs fail before the database is touched."""
+        reader.import_xml(self.xml, self.dbname, create=True)
+        self.assertRaises(ValueError, reader.expand_inputs, ['nomatch*.xml'])
+        self.assertRaises(ValueError, reader.expand_inputs, ['missing.xml'])
+        self.assertRaises(ValueError, reader.import_many, [], self.dbname, create=True)
+        self.check_db(self.spec)
+
+    def test_snapshot(self):
+        """A binary snapshot serves the same topology as the database."""
+        reader.import_xml(self.xml, self.dbname, create=True)
+        tsdb = database.Database(self.dbname)
+        tsdb.write_snapshot('test.snap')
+        self.addCleanup(os.unlink, 'test.snap')
+        snap = database.Snapshot('test.snap')
+        self.addCleanup(snap.close)
+        self.assertEqual(repr(list(snap.read_all())), repr(list(tsdb.read_all())))
+        for tsi in xrange(len(self.spec)+2):
+            self.assertEqual(snap.read_system(tsi), tsdb.read_system(tsi))
+            self.assertEqual(list(snap.read_servers(tsi)), list(tsdb.read_servers(tsi)))
+
+    def test_conflict(self):
+        """Importing servers whose addresses are in use fails without
+        changing the database."""
+        reader.import_xml(self.xml, self.dbname, create=True)
+        self.assertRaises(database.AddressConflict,
+            reader.import_xml, self.xml, self.dbname, create=False, chunk=7)
+        self.check_db(self.spec)
+        tsdb = database.Database(self.dbname)
+        self.assertRaises(database.AddressConflict,
+            tsdb.write_server, 1, 'LOCALHOST:2050', 'dup')
+
+    def test_invalid_port(self):
+        """Non-numeric ports are reported by address; older databases
+        containing them can still be opened."""
+        fpw = open(self.xml, 'wb')
+        fpw.write('<testsystem><system name="ts0">'
+            '<server addr="localhost:abc" name="a" />'
+            '</system></testsystem>')
+        fpw.close()
+        with self.assertRaisesRegexp(ValueError, 'localhost:abc'):
+            reader.import_xml(self.xml, self.dbname, create=True)
+        dbc = sqlite3.connect(self.dbname)
+        dbc.execute("DROP TABLE address")
+        dbc.execute("INSERT INTO server (system_id, addr, name) VALUES (1, 'host:abc', 'a')")
+        dbc.commit()
+        dbc.close()
+        tsdb = database.Database(self.dbname)
+        self.assertEqual(tsdb.index_addresses(), ['host:abc'])
+
+    def test_port_range(self):
+        """Ports outside 1..65535, and invalid allocation ranges, are rejected."""
+        for addr in ('h0:0', 'h0:-1', 'h0:65536', 'h0:99999'):
+            with self.assertRaisesRegexp(ValueError, addr):
+                database.normaddr(addr)
+        self.assertEqual(database.normaddr('H0:65535'), ('h0', 65535))
+        for ports in ((0, 10), (2060, 2050), (65000, 70000)):
+            with self.assertRaisesRegexp(ValueError, 'Invalid port range'):
+                reader.import_many([self.xml], self.dbname, ports=ports)
+        self.assertFalse(os.path.exists(self.dbname))
+
+    def test_allocate(self):
+        """Servers without a port are allocated free ports from a range."""
+        fpw = open(self.xml, 'wb')
+        fpw.write('<testsystem><system name="ts0">'
+            '<server addr="localhost:2051" name="a" />'
+            '<server addr="localhost" name="b" />'
+            '<server name="c" />'
+            '<server addr="otherhost" name="d" />'
+            '</system></testsystem>')
+        fpw.close()
+        reader.import_xml(self.xml, self.dbname, create=True, ports=(2050, 2060))
+        tsdb = database.Database(self.dbname)
+        addrs = [srv.addr for srv in list(tsdb.read_all())[0]]
+        self.assertEqual(addrs,
+            ['localhost:2051', 'localhost:2050', 'localhost:2052', 'otherhost:2050'])
+
+    def test_wal(self):
+        """Database is switched to WAL journaling when opened for writing."""
+        reader.import_xml(self.xml, self.dbname, create=True)
+        dbc = sqlite3.connect(self.dbname)
+        mode = dbc.execute("PRAGMA journal_mode").fetchone()[0]
+        self.assertEqual(mode.lower(), 'wal')
+
+    def test_readonly(self):
+        """Read-only connections can query but not modify the database."""
+        reader.import_xml(self.xml, self.dbname, create=True)
+        tsdb = database.Database(self.dbname, readonly=True)
+        self.assertEqual(len(list(tsdb.read_all())), len(self.spec))
+        self.assertRaises(sqlite3.OperationalError, tsdb.write_system, 'tsx')
+
+    def test_concurrent_read(self):
+        """A reader is not blocked while a writer has uncommitted changes."""
+        reader.import_xml(self.xml, self.dbname, create=True)
+        writer = database.Database(self.dbname)
+        writer.write_system('tsx')
+        tsdb = database.Database(self.dbname, readonly=True, timeout=0.1)
+        self.assertEqual(len(list(tsdb.read_all())), len(self.spec))
+        writer.commit()
+
 
 class CoordTests(unittest.TestCase):
     """Coordinator test suite."""
@@ -191,6 +314,42 @@ class ServerTests(unittest.TestCase):
         self.req_resp('QUIT')
 
 
+class LoadGenTests(unittest.TestCase):
+    """Load generator test suite. Drives a standalone server in a thread."""
+
+    def setUp(self):
+        """Start server thread."""
+        srv = ServerThread()
+        srv.daemon = True
+        srv.start()
+        time.sleep(0.1) # Allow time for server (in thread) to start
+
+    def tearDown(self):
+        """Tell server to shutdown."""
+        coord.Coordinator().quit('localhost', '2050')
+
+    def test_requests(self):
+        """Issue a fixed number of HELO and ID requests per client."""
+        gen = loadgen.LoadGenerator(['localhost:2050'], clients=2, requests=10,
+            commands=('HELO', 'ID'))
+        stats = gen.run()
+        self.assertEqual((stats.requests, stats.errors, stats.refused), (20, 0, 0))
+        self.assertTrue(stats.p50 <= stats.p95 <= stats.p99)
+
+    def test_refused(self):
+        """Connections to an address with no server are counted as refused."""
+        gen = loadgen.LoadGenerator(['localhost:2049'], clients=1, requests=3)
+        stats = gen.run()
+        self.assertEqual((stats.requests, stats.refused), (3, 3))
+        self.assertEqual(stats.p50, None)
+
+    def test_scheduled(self):
+        """Paced requests are timed from when they were due, not sent."""
+        gen = loadgen.LoadGenerator(['localhost:2050'])
+        self.assertTrue(gen.request('localhost', 2050, 'HELO', time.time() - 1.0) >= 1.0)
+        self.assertTrue(gen.request('localhost', 2050, 'HELO') < 1.0)
+
+
 class WebTests(unittest.TestCase):
     """Web test suite.
     Tests are numbered to ensure they are carried out in a specific order."""
@@ -203,6 +362,7 @@ class WebTests(unittest.TestCase):
         create_xml(self.xml, self.spec)
         reader.import_xml(self.xml, self.dbname, create=True)
         web.dbname = self.dbname
+        web.snapname = None
 
     def tearDown(self):
         """Try to ensure all processes are shutdown, even if the tests failed."""
@@ -244,8 +404,132 @@ class WebTests(unittest.TestCase):
     def test_4_stop(self):
         """Simulate click on "Stop" for first test-system."""
         self.assertEqual(sha(web.stop(1), hex=True), SHA_STOP_PAGE)
-        
+
+    def test_5_snapshot(self):
+        """Check root page when served from a binary snapshot."""
+        database.Database(self.dbname).write_snapshot('test.snap')
+        web.snapname = 'test.snap'
+        try:
+            self.assertEqual(sha(web.index(), hex=True), SHA_INDEX_PAGE)
+            tsdb = web.setup()[0]
+            self.assertTrue(web.setup()[0] is tsdb)
+            database.Database(self.dbname).write_snapshot('test.snap')
+            self.assertFalse(web.setup()[0] is tsdb)
+        finally:
+            web.snapname = None
+            os.unlink('test.snap')
+
+    def test_6_compiled(self):
+        """Check root page when rendered from precompiled templates."""
+        web.template_cache = 'test-compiled'
+        web.env = None
+        try:
+            web.compile_templates()
+            self.assertTrue(web.templates_compiled())
+            self.assertEqual(sha(web.index(), hex=True), SHA_INDEX_PAGE)
+            self.assertEqual(type(web.env.loader).__name__, 'ModuleLoader')
+        finally:
+            web.env = None
+            web.template_cache = 'templates_compiled'
+            shutil.rmtree('test-compiled', ignore_errors=True)
+
+
+class TracingTests(unittest.TestCase):
+    """Tracing and profiling test suite."""
+
+    def setUp(self):
+        """Create a database for traced queries."""
+        self.xml = 'test.xml'
+        self.dbname = 'test.db'
+        create_xml(self.xml, (3, 2))
+        reader.import_xml(self.xml, self.dbname, create=True)
+        web.dbname = self.dbname
+        web.snapname = None
+
+    def tearDown(self):
+        """Disable tracing and profiling again."""
+        tracing.enabled = False
+        web.profile_routes = None
+        web.trace_header = False
+
+    def test_disabled(self):
+        """Spans are not recorded while tracing is disabled."""
+        self.assertTrue(tracing.span('test') is tracing.NULL_SPAN)
+        tracing.begin()
+        list(database.Database(self.dbname).read_all())
+        self.assertEqual(tracing.end(), [])
+
+    def test_spans(self):
+        """Database queries and coordinator calls are traced."""
+        tracing.configure()
+        tracing.begin()
+        list(database.Database(self.dbname).read_all())
+        coord.Coordinator().bool_check('localhost:2049')
+        names = [name for name, _ in tracing.end()]
+        self.assertEqual(names, ['db.read_all', 'db.read_servers',
+            'db.read_servers', 'coord.bool_check'])
+
+    def test_configure_once(self):
+        """Configuring twice registers one set of hooks and one log handler."""
+        self.addCleanup(shutil.rmtree, 'test-profiles', True)
+        web.configure_profiling(['index'], directory='test-profiles')
+        web.configure_profiling(['index'], directory='test-profiles')
+        self.assertEqual(web.app.before_request_funcs[None].count(web.start_request), 1)
+        self.assertEqual(web.app.after_request_funcs[None].count(web.finish_request), 1)
+        self.addCleanup(os.unlink, 'test-trace.log')
+        self.addCleanup(setattr, tracing, 'log', None)
+        tracing.configure('test-trace.log')
+        tracing.configure('test-trace.log')
+        self.assertEqual(len(tracing.log.handlers), 1)
+        handler = tracing.log.handlers[0]
+        self.addCleanup(tracing.log.removeHandler, handler)
+        self.addCleanup(handler.close)
+
+    def test_snapshot_spans(self):
+        """Snapshot reads are traced like the equivalent database queries."""
+        tsdb = database.Database(self.dbname)
+        tsdb.write_snapshot('test.snap')
+        self.addCleanup(os.unlink, 'test.snap')
+        snap = database.Snapshot('test.snap')
+        self.addCleanup(snap.close)
+        tracing.configure()
+        names = []
+        for source in (tsdb, snap):
+            tracing.begin()
+            list(source.read_all())
+            source.read_system(1)
+            list(source.read_servers(1))
+            names.append([name for name, _ in tracing.end()])
+        self.assertEqual(names[0], names[1])
+
+    def test_profile(self):
+        """Profiled routes are dumped per route; spans returned in a header."""
+        self.addCleanup(shutil.rmtree, 'test-profiles', True)
+        web.configure_profiling(['index'], directory='test-profiles', header=True)
+        resp = web.app.test_client().get('/')
+        self.assertTrue(os.path.exists(os.path.join('test-profiles', 'index.prof')))
+        self.assertTrue('template.index.html' in resp.headers['X-Trace'])
+
+
+class StartupTests(unittest.TestCase):
+    """Startup test suite. Checks heavy modules are only imported by the
+    code paths which need them."""
+
+    def test_lazy_imports(self):
+        """Importing reader does not load lxml; tracing does not load logging;
+        importing web does not load the database, reader or profiler."""
+        self.assertFalse(startup.loaded('lxml', 'import reader'))
+        self.assertFalse(startup.loaded('logging', 'import database'))
+        for module in ('database', 'reader', 'lxml', 'cProfile'):
+            self.assertFalse(startup.loaded(module, 'import web'), module)
+        self.assertTrue(startup.loaded('lxml', 'import reader; reader.parse_xml("sample.xml")'))
+
+    def test_measure(self):
+        """Startup times are measured per run, fastest first."""
+        times = startup.measure([sys.executable, '-c', 'pass'], 3)
+        self.assertEqual(len(times), 3)
+        self.assertEqual(times, sorted(times))
+
 
 if __name__ == "__main__":
     unittest.main()
-
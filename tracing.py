@@ -0,0 +1,117 @@
+"""Lightweight tracing for LITE. Code marks out spans (database queries,
+coordinator calls) with span() or the traced() decorator. Tracing is off
+by default, when a span costs a single global check; configure() turns it
+on, logging each span to a rotating log file and/or collecting the spans
+of the current request so they can be returned to the client.
+"""
+
+import functools
+import threading
+import time
+import os
+
+
+__author__ = "Rory MacHale"
+__version__ = "1.0"
+__date__ = "2015-05-15"
+
+
+enabled = False
+log = None # Logger, created by configure() if a log file is used
+local = threading.local()
+
+
+class NullSpan(object):
+    """Span used while tracing is disabled. Does nothing."""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span(object):
+    """Times the enclosed block and records it under name."""
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, time.time() - self.start)
+        return False
+
+
+def span(name):
+    """Return a context manager which traces the enclosed block as name."""
+    if not enabled:
+        return NULL_SPAN
+    return Span(name)
+
+
+def traced(name):
+    """Decorator which traces each call of the function as name."""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            with Span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def record(name, secs):
+    """Log a finished span, and add it to the current request (if any)."""
+    spans = getattr(local, 'spans', None)
+    if spans is not None:
+        spans.append((name, secs))
+    if log is not None:
+        log.debug("%s %.3fms", name, secs*1000)
+
+
+def begin():
+    """Start collecting the spans of a request in this thread."""
+    local.spans = []
+
+
+def end():
+    """Stop collecting spans in this thread and return them as a list of
+    (name, seconds) tuples."""
+    spans = getattr(local, 'spans', None) or []
+    local.spans = None
+    return spans
+
+
+def format_spans(spans):
+    """Format spans compactly, e.g. for an HTTP header."""
+    return '; '.join('{0}={1:.3f}ms'.format(name, secs*1000) for name, secs in spans)
+
+
+def configure(logfile=None, maxbytes=1024*1024, backups=3):
+    """Enable tracing. If logfile is given, spans are written to it,
+    rotating after maxbytes and keeping backups old files. Configuring the
+    same log file again does not add a second handler."""
+    global enabled, log
+    enabled = True
+    if logfile:
+        import logging
+        import logging.handlers
+        log = logging.getLogger('lite.trace')
+        path = os.path.abspath(logfile)
+        if any(getattr(handler, 'baseFilename', None) == path
+               for handler in log.handlers):
+            return
+        handler = logging.handlers.RotatingFileHandler(
+            logfile, maxBytes=maxbytes, backupCount=backups)
+        handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        log.addHandler(handler)
+        log.setLevel(logging.DEBUG)
+        log.propagate = False
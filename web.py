@@ -4,10 +4,9 @@ If <name>.db file not found, attempts to create from <name>.xml.
 Processes requests to deploy, check and stop test-systems.
 """
 
-from flask import Flask
-from jinja2 import Environment, FileSystemLoader
-import database
-import coord
+from flask import Flask, g, request
+import tracing
+import threading
 import os
 
 
@@ -18,14 +17,85 @@ __date__ = "2015-05-15"
 
 app = Flask(__name__)
 dbname = None
+snapname = None
+snapshot = None # Snapshot of snapname, remapped when the file changes
+
+# Templates are loaded from TEMPLATE_DIR, or from modules precompiled into
+# template_cache if these are up to date (see compile_templates)
+TEMPLATE_DIR = './'
+TEMPLATES = ('index.html', 'go.html')
+template_cache = 'templates_compiled'
+env = None
+
+# Request profiling, configured by --profile (see configure_profiling)
+profile_routes = None
+profile_every = 1
+profile_dir = None
+profile_stats = {}
+profile_count = {}
+profile_lock = threading.Lock()
+trace_header = False
+hooked = False # True once start_request/finish_request are registered
+
+
+def templates_compiled():
+    """Return True if every template has a precompiled module in
+    template_cache which is newer than the template source."""
+    from jinja2 import ModuleLoader
+    for name in TEMPLATES:
+        module = os.path.join(template_cache, ModuleLoader.get_module_filename(name))
+        if not os.path.exists(module) or os.path.getmtime(module) < \
+                os.path.getmtime(os.path.join(TEMPLATE_DIR, name)):
+            return False
+    return True
+
+
+def compile_templates():
+    """Precompile the templates into Python modules in template_cache, so
+    they need not be parsed and compiled when first requested."""
+    from jinja2 import Environment, FileSystemLoader
+    source = Environment(loader=FileSystemLoader(TEMPLATE_DIR))
+    source.compile_templates(template_cache, zip=None,
+        filter_func=lambda name: name in TEMPLATES)
+
+
+def get_env():
+    """Return the template environment, created on first use. Precompiled
+    templates are used if they are up to date."""
+    global env
+    if env is None:
+        from jinja2 import Environment, FileSystemLoader, ModuleLoader
+        if templates_compiled():
+            env = Environment(loader=ModuleLoader(template_cache))
+        else:
+            env = Environment(loader=FileSystemLoader(TEMPLATE_DIR))
+    return env
 
 
 def setup():
-    """Create support objects for each web-page."""
-    tsdb = database.Database(dbname)
-    env = Environment(loader=FileSystemLoader('./'))
+    """Create support objects for each web-page. The topology is read from
+    the binary snapshot if one is configured, otherwise from the database.
+    The snapshot is mapped on first use and shared by later requests, until
+    the file is replaced (e.g. by re-running reader snapshot). The old map
+    is not closed, as other threads may still be reading it; it is unmapped
+    once the last of them drops it."""
+    import database
+    import coord
+    global snapshot
+    if snapname:
+        if snapshot is None or snapshot.name != snapname or snapshot.changed():
+            snapshot = database.Snapshot(snapname)
+        tsdb = snapshot
+    else:
+        tsdb = database.Database(dbname, readonly=True)
     coo = coord.Coordinator()
-    return tsdb, env, coo
+    return tsdb, get_env(), coo
+
+
+def render(env, name, **kwargs):
+    """Load and render a template, traced as template.<name>."""
+    with tracing.span('template.'+name):
+        return env.get_template(name).render(**kwargs)
 
 
 def talk(func, tsdb, env, ts_id):
@@ -33,23 +103,20 @@ def talk(func, tsdb, env, ts_id):
     results for a single specified test-system ts_id."""
     servers = tsdb.read_servers(ts_id)
     status = [func(ts_id, server[2]) for server in servers]
-    tmpl = env.get_template('go.html')
-    return tmpl.render(status=status)
+    return render(env, 'go.html', status=status)
 
 
 @app.route('/')
 def index():
     """Display the main status page, with clickable links, for LITE."""
     tsdb, env, coo = setup()
-    tsdb = database.Database(dbname)
     allsys = list(tsdb.read_all())
     status = {}
     for tsi in xrange(len(allsys)):
         tss = allsys[tsi]
         status.update({server.name: coo.bool_check(server.addr)
             for server in tss})
-    tmpl = env.get_template('index.html')
-    return tmpl.render(systems=allsys, status=status)
+    return render(env, 'index.html', systems=allsys, status=status)
 
 
 @app.route('/go/<int:ts_id>')
@@ -60,8 +127,7 @@ def go(ts_id):
     tss = tsdb.read_system(ts_id)
     servers = tsdb.read_servers(ts_id)
     status = [coo.deploy(tss, server[3], server[2]) for server in servers]
-    tmpl = env.get_template('go.html')
-    return tmpl.render(status=status)
+    return render(env, 'go.html', status=status)
 
 
 @app.route('/check/<int:ts_id>')
@@ -78,12 +144,84 @@ def stop(ts_id):
     return talk(coo.stop, tsdb, env, ts_id)
 
 
-def initialise(dbname, port): # pragma: no cover
+def start_request():
+    """Before each request: start collecting trace spans, and start the
+    profiler if the route is selected and this request is sampled."""
+    if tracing.enabled:
+        tracing.begin()
+    endpoint = request.endpoint
+    if profile_routes is None or (
+            'all' not in profile_routes and endpoint not in profile_routes):
+        return
+    with profile_lock:
+        count = profile_count.get(endpoint, 0)
+        profile_count[endpoint] = count + 1
+    if count % profile_every == 0:
+        import cProfile
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+
+def finish_request(response):
+    """After each request: stop the profiler and add its results to the
+    route's profile, dumped as <profile_dir>/<route>.prof, and return the
+    trace spans in an X-Trace header if requested."""
+    profiler = getattr(g, 'profiler', None)
+    if profiler is not None:
+        import pstats
+        profiler.disable()
+        g.profiler = None
+        with profile_lock:
+            endpoint = request.endpoint
+            if endpoint in profile_stats:
+                profile_stats[endpoint].add(profiler)
+            else:
+                profile_stats[endpoint] = pstats.Stats(profiler)
+            profile_stats[endpoint].dump_stats(
+                os.path.join(profile_dir, '{0}.prof'.format(endpoint)))
+    if tracing.enabled:
+        spans = tracing.end()
+        if trace_header:
+            response.headers['X-Trace'] = tracing.format_spans(spans)
+    return response
+
+
+def configure_profiling(routes=None, every=1, directory='profiles',
+                        tracelog=None, header=False):
+    """Enable request profiling and/or tracing. routes is a list of route
+    (endpoint) names to profile, or ['all']; every Nth request to each
+    route is profiled. tracelog is a rotating log file for trace spans, and
+    if header is True spans are returned in an X-Trace response header.
+    Nothing is hooked into request handling unless enabled here, and the
+    hooks are registered only once however often this is called."""
+    global profile_routes, profile_every, profile_dir, trace_header, hooked
+    if routes:
+        profile_routes = set(routes)
+        profile_every = max(1, every)
+        profile_dir = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+    if tracelog or header:
+        tracing.configure(tracelog)
+        trace_header = header
+    if (routes or tracelog or header) and not hooked:
+        app.before_request(start_request)
+        app.after_request(finish_request)
+        hooked = True
+
+
+def initialise(dbname, port, snapname=None): # pragma: no cover
     """Check database. If not found, look for <name>.xml corresponding
     to <name>.db database, and try to import the XML into the database
-    automatically."""
+    automatically. The database is not needed if pages are served from
+    the snapshot snapname. Precompile the templates if they have changed."""
     print
-    if not os.path.exists(dbname):
+    if not templates_compiled():
+        compile_templates()
+        print "** Compiled templates to {0}".format(template_cache)
+    if snapname:
+        print "** Serving topology from {0}".format(snapname)
+    elif not os.path.exists(dbname):
         import reader
         path, _ = os.path.splitext(dbname)
         xmlname = path+'.xml'
@@ -99,8 +237,21 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser("LITE: Little IT Environment - emulator")
     parser.add_argument('-d', '--db', default='sample.db', help="SQLite DB filename")
     parser.add_argument('-p', '--port', default=50000, type=int, help="Web server port")
+    parser.add_argument('-s', '--snapshot', help="Serve topology from snapshot file")
+    parser.add_argument('--profile', metavar='ROUTE', nargs='+',
+        help="cProfile these routes (index, go, check, stop or all)")
+    parser.add_argument('--profile-every', default=1, type=int, metavar='N',
+        help="Profile every Nth request to each route")
+    parser.add_argument('--profile-dir', default='profiles',
+        help="Directory for per-route <route>.prof files")
+    parser.add_argument('--trace-log', help="Rotating log file for trace spans")
+    parser.add_argument('--trace-header', action='store_true',
+        help="Return trace spans in an X-Trace response header")
     args = parser.parse_args()
     dbname = args.db
-    initialise(args.db, args.port)
+    snapname = args.snapshot
+    configure_profiling(args.profile, args.profile_every, args.profile_dir,
+        args.trace_log, args.trace_header)
+    initialise(args.db, args.port, args.snapshot)
     app.run(debug=True, port=args.port)
 